@@ -1,8 +1,16 @@
 
 import streamlit as st
+import PIL
 from PIL import Image, ImageOps
+import numpy as np
+import pandas as pd
+from base64 import b64encode
+from io import BytesIO
+import hashlib
 import os
 
+from blend import blend_over
+
 # --- Configuration ---
 st.set_page_config(
     page_title="Virtual Fitting Room",
@@ -10,31 +18,276 @@ st.set_page_config(
     layout="wide"
 )
 
+# Bound for the user photo used in the preview; downloads use the full-resolution original
+PREVIEW_SIZE = (1024, 1024)
+# Granularity of the clothing size slider, also used to bucket cached resizes
+SCALE_STEP = 0.05
+
 # --- Helper Functions ---
 def get_image_path(image_name):
     """Constructs the full path for an image in the 'images' directory."""
     return os.path.join("images", image_name)
 
-def load_image(image_path, size=None):
-    """Loads an image from a file path and optionally resizes it."""
+@st.cache_data(show_spinner=False, max_entries=16)
+def decode_image(image_path, size, max_size, mtime):
+    """Decodes an image once per path, size and modification time."""
+    img = Image.open(image_path)
+    target_size = size or max_size
+    if target_size and img.format == "JPEG":
+        # Let libjpeg decode at a reduced scale that still covers the target
+        img.draft("RGB", target_size)
+    if size:
+        img = ImageOps.fit(img, size, Image.Resampling.LANCZOS)
+    elif max_size:
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    # Force the decode now so the cached copy holds the pixel data
+    img.load()
+    return img
+
+def load_image(image_path, size=None, max_size=None):
+    """Loads an image from a file path and optionally resizes it.
+
+    ``size`` crops and resizes to exact dimensions, while ``max_size`` only
+    shrinks the image to fit within the bound, keeping its aspect ratio.
+    """
     try:
-        img = Image.open(image_path)
-        if size:
-            img = ImageOps.fit(img, size, Image.Resampling.LANCZOS)
-        return img
+        mtime = os.path.getmtime(image_path)
+        # Reuse this session's decoded copy so reruns skip even the cache unpickling.
+        # One image is kept per requested size (the current photo and the current
+        # garment), so switching either replaces its entry instead of adding one.
+        decoded = st.session_state.setdefault("decoded_images", {})
+        key = (size, max_size)
+        if decoded.get(key, (None, None))[0] != (image_path, mtime):
+            decoded[key] = ((image_path, mtime), decode_image(image_path, size, max_size, mtime))
+        return decoded[key][1]
     except FileNotFoundError:
         st.error(f"Error: Image not found at {image_path}")
         return None
 
-def overlay_image(background_img, overlay_img, position=(0, 0)):
-    """Overlays one image on top of another at a specified position."""
-    # Create a copy of the background to avoid modifying the original
-    background = background_img.copy()
-    # Ensure the overlay image has an alpha channel for transparency
-    overlay_img = overlay_img.convert("RGBA")
-    # Paste the overlay onto the background using the alpha channel as a mask
-    background.paste(overlay_img, position, overlay_img)
-    return background
+def get_scaled_clothing(clothing_image_path, scale_steps, mtime, resample=Image.Resampling.LANCZOS):
+    """Resizes a clothing image to a step of the size slider.
+
+    The interactive preview passes a cheaper ``resample`` filter; the download keeps LANCZOS.
+    """
+    img = decode_image(clothing_image_path, None, None, mtime).convert("RGBA")
+    width, height = scaled_size(img.size, scale_steps * SCALE_STEP)
+    if (width, height) == img.size:
+        return img
+    return img.resize((width, height), resample)
+
+def get_visible_clothing(clothing_image_path, scale, mtime, position, background_size, resample=Image.Resampling.LANCZOS):
+    """Resizes only the part of the clothing, scaled by ``scale``, that lands on the background.
+
+    Returns the visible part as an RGBA image together with its position on the
+    background, or ``None`` when the clothing is entirely off-canvas.
+    """
+    img = decode_image(clothing_image_path, None, None, mtime).convert("RGBA")
+    width, height = scaled_size(img.size, scale)
+    x0, y0, x1, y1 = visible_rect(position, (width, height), background_size)
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    # Map the visible rectangle back to source pixels so only that region is resampled
+    x, y = position
+    sx, sy = img.width / width, img.height / height
+    box = ((x0 - x) * sx, (y0 - y) * sy, (x1 - x) * sx, (y1 - y) * sy)
+    visible = img.resize((x1 - x0, y1 - y0), resample, box=box)
+    return visible, (x0, y0)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def scaled_clothing_uri(clothing_image_path, scale_steps, mtime):
+    """Returns the whole scaled clothing image as a data URI, once per slider step."""
+    # BILINEAR is much cheaper than LANCZOS and the difference is not visible in the preview
+    return data_uri(get_scaled_clothing(clothing_image_path, scale_steps, mtime, Image.Resampling.BILINEAR))
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def cropped_clothing_uri(clothing_image_path, scale_steps, mtime, position, background_size):
+    """Returns the on-canvas part of the scaled clothing as a data URI and its (x, y) position."""
+    visible = get_visible_clothing(
+        clothing_image_path, scale_steps * SCALE_STEP, mtime, position, background_size, Image.Resampling.BILINEAR
+    )
+    if visible is None:
+        return None
+    img, visible_position = visible
+    return data_uri(img), visible_position
+
+def preview_overlay(clothing_image_path, clothing_size, scale_steps, mtime, position, background_size):
+    """Returns the clothing layer for the preview as a (data URI, box) pair.
+
+    When the scaled clothing fits on the background, the whole image is sent
+    once per slider step and moved in CSS, so position changes cost nothing.
+    Only clothing that extends past the background is cropped to its visible
+    part, which keeps large scales cheap. ``None`` means nothing is visible.
+    """
+    width, height = scaled_size(clothing_size, scale_steps * SCALE_STEP)
+    x0, y0, x1, y1 = visible_rect(position, (width, height), background_size)
+    if (x0, y0, x1, y1) == (position[0], position[1], position[0] + width, position[1] + height):
+        return scaled_clothing_uri(clothing_image_path, scale_steps, mtime), (x0, y0, width, height)
+    cropped = cropped_clothing_uri(clothing_image_path, scale_steps, mtime, position, background_size)
+    if cropped is None:
+        return None
+    uri, visible_position = cropped
+    return uri, (*visible_position, x1 - x0, y1 - y0)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def read_clothing_csv(csv_path, mtime):
+    """Parses the clothing CSV once per modification time."""
+    df = pd.read_csv(csv_path, usecols=["name", "image_file"], dtype="string")
+    return dict(zip(df["name"].tolist(), df["image_file"].tolist()))
+
+def load_clothing_data(csv_path="clothing_data.csv"):
+    """Loads clothing data from the CSV file."""
+    try:
+        return read_clothing_csv(csv_path, os.path.getmtime(csv_path))
+    except FileNotFoundError:
+        st.error("Error: clothing_data.csv not found.")
+        return {}
+    except Exception as e:
+        st.error(f"An error occurred while loading clothing data: {e}")
+        return {}
+
+def save_avatar(image_path, avatar_path):
+    """Saves the full-resolution original of an image as the PNG avatar.
+
+    The file is decoded directly rather than through load_image, so a bounded
+    display copy can never overwrite the avatar.
+    """
+    with Image.open(image_path) as img:
+        img.save(avatar_path, "PNG")
+
+def scaled_size(size, scale):
+    """Returns an image size scaled by ``scale``, never smaller than one pixel."""
+    width, height = size
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def visible_rect(position, overlay_size, background_size):
+    """Returns the (x0, y0, x1, y1) part of a placed overlay that lies inside the background."""
+    x, y = position
+    width, height = overlay_size
+    bg_width, bg_height = background_size
+    return max(0, x), max(0, y), min(bg_width, x + width), min(bg_height, y + height)
+
+def premultiply_alpha(img):
+    """Returns an image as an RGBA uint8 array with its colour already scaled by alpha."""
+    rgba = np.array(img.convert("RGBA"))
+    alpha = rgba[..., 3:4].astype(np.uint16)
+    rgba[..., :3] = rgba[..., :3] * alpha // 255
+    return rgba
+
+def overlay_image(background_img, overlay, position=(0, 0)):
+    """Overlays a premultiplied RGBA array on top of an image at a specified position."""
+    # Copy the background into a writable array to avoid modifying the original;
+    # RGB photos are copied straight in, skipping a convert("RGBA") round trip
+    if background_img.mode == "RGB":
+        width, height = background_img.size
+        background = np.empty((height, width, 4), dtype=np.uint8)
+        background[..., :3] = np.asarray(background_img)
+        background[..., 3] = 255
+    else:
+        background = np.array(background_img.convert("RGBA"))
+
+    # Clip the overlay rectangle to the background bounds
+    x, y = position
+    x0, y0, x1, y1 = visible_rect(position, overlay.shape[1::-1], background_img.size)
+    if x0 >= x1 or y0 >= y1:
+        return Image.fromarray(background)
+
+    # Porter-Duff "over" on the overlapping region: out = fg + (1 - a) * bg
+    fg = overlay[y0 - y:y1 - y, x0 - x:x1 - x]
+    blend_over(background[y0:y1, x0:x1], fg)
+    return Image.fromarray(background)
+
+def data_uri(img):
+    """Encodes an image as a base64 data URI, JPEG for opaque 8-bit images and PNG otherwise."""
+    if img.mode.startswith(("I", "F")):
+        # 16-bit and float greyscale (e.g. some PNG uploads) can't be written as JPEG.
+        # Keep the high byte rather than letting convert("L") clip everything above 255.
+        pixels = np.asarray(img.convert("I")) >> 8
+        img = Image.fromarray(pixels.clip(0, 255).astype(np.uint8))
+    if img.mode in ("RGB", "L"):
+        fmt = "JPEG"
+    else:
+        fmt = "PNG"
+        if img.mode not in ("RGBA", "LA", "P", "1"):
+            img = img.convert("RGBA")
+    buf = BytesIO()
+    if fmt == "PNG":
+        # Fast deflate: the preview layers are encoded often, so speed beats size
+        img.save(buf, format=fmt, compress_level=1)
+    else:
+        img.save(buf, format=fmt)
+    return f"data:image/{fmt.lower()};base64,{b64encode(buf.getvalue()).decode('ascii')}"
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def image_data_uri(_img, cache_key):
+    """Encodes an image as a base64 data URI, once per cache key."""
+    return data_uri(_img)
+
+def make_composite(user_image_path, user_mtime, clothing_image_path, clothing_mtime, scale_steps, position, preview_size):
+    """Composites the try-on image for one look, at the photo's full resolution.
+
+    ``scale_steps`` is the size slider snapped to SCALE_STEP. ``position`` is in
+    the coordinates of the ``preview_size`` photo and is scaled up to the
+    original. Results are memoized by build_download, keyed on the same
+    snapped slider state.
+    """
+    user_image = decode_image(user_image_path, None, None, user_mtime)
+    ratio = user_image.width / preview_size[0]
+    position = (round(position[0] * ratio), round(position[1] * ratio))
+    # The composite is built once per look, so it gets the sharper LANCZOS filter
+    visible = get_visible_clothing(
+        clothing_image_path,
+        scale_steps * SCALE_STEP * ratio,
+        clothing_mtime,
+        position,
+        user_image.size,
+        Image.Resampling.LANCZOS,
+    )
+    if visible is None:
+        return user_image
+    clothing, visible_position = visible
+    return overlay_image(user_image, premultiply_alpha(clothing), visible_position)
+
+def is_jpeg_path(image_path):
+    """Returns True when a file name has a JPEG extension."""
+    return os.path.splitext(image_path)[1].lower() in (".jpg", ".jpeg")
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_download(user_image_path, user_mtime, clothing_image_path, clothing_mtime, scale_steps, position, preview_size, fmt):
+    """Encodes the composited try-on image as ``fmt`` ("PNG" or "JPEG") bytes for download."""
+    final_image = make_composite(
+        user_image_path, user_mtime, clothing_image_path, clothing_mtime, scale_steps, position, preview_size
+    )
+    buf = BytesIO()
+    if fmt == "JPEG":
+        # Photo backgrounds have no transparency to keep, and JPEG encodes far faster than deflate
+        final_image.convert("RGB").save(buf, format="JPEG", quality=90, optimize=False, progressive=False)
+    else:
+        # Fast deflate: a slightly larger file is a fair trade for a quicker download
+        final_image.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+def layered_preview_html(background_uri, overlay, background_size):
+    """Builds HTML that stacks the overlay on the background in the browser.
+
+    ``overlay`` is a (data URI, box) pair as returned by preview_overlay, or
+    ``None`` to show the background alone. Positions are given as percentages
+    of the background so the preview scales with the container width.
+    """
+    overlay_html = ""
+    if overlay is not None:
+        overlay_uri, (x, y, width, _) = overlay
+        bg_width, bg_height = background_size
+        left = 100 * x / bg_width
+        top = 100 * y / bg_height
+        overlay_width = 100 * width / bg_width
+        overlay_html = f"""
+  <img src="{overlay_uri}" style="position:absolute;left:{left:.4f}%;top:{top:.4f}%;width:{overlay_width:.4f}%;max-width:none;"/>"""
+    return f"""
+<div style="position:relative;width:100%;overflow:hidden;line-height:0;">
+  <img src="{background_uri}" style="display:block;width:100%;"/>{overlay_html}
+</div>
+"""
 
 # --- Image Assets ---
 # Create a directory for images if it doesn't exist
@@ -67,41 +320,34 @@ with col1:
     uploaded_file = st.file_uploader("Choose a new photo or use your saved avatar...", type=["jpg", "jpeg", "png"])
 
     if uploaded_file is not None:
-        # When a new file is uploaded, it becomes the current image
-        user_image_path = get_image_path(uploaded_file.name)
-        with open(user_image_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        st.session_state.user_image_path = user_image_path
+        # When a new file is uploaded, it becomes the current image.
+        # Reruns keep the same upload, so only write it to disk when its contents change.
+        upload_hash = hashlib.blake2b(uploaded_file.getbuffer(), digest_size=16).hexdigest()
+        if st.session_state.get("uploaded_hash") != upload_hash:
+            # Name the file after its contents so sessions uploading the same file name
+            # can't overwrite each other's photo behind the path + mtime caches
+            user_image_path = get_image_path(f"{upload_hash}{os.path.splitext(uploaded_file.name)[1].lower()}")
+            with open(user_image_path, "wb") as f:
+                f.write(uploaded_file.getbuffer())
+            st.session_state.uploaded_hash = upload_hash
+            st.session_state.user_image_path = user_image_path
     
     # Display the current user image (either avatar or newly uploaded)
     if 'user_image_path' in st.session_state:
-        user_image = load_image(st.session_state.user_image_path)
+        user_image = load_image(st.session_state.user_image_path, max_size=PREVIEW_SIZE)
         if user_image:
             st.image(user_image, caption="This is you!", use_column_width=True)
             
             # --- Save Avatar Button ---
             if st.button("Save as My Avatar"):
-                # Save the currently displayed image to the avatar path
-                user_image.save(AVATAR_PATH, "PNG")
+                # Save the full-resolution original rather than the display copy
+                save_avatar(st.session_state.user_image_path, AVATAR_PATH)
                 st.success("Avatar saved! It will be loaded automatically next time.")
 
 with col2:
     st.header("Choose Your Style")
     
     # --- Dynamic Clothing Loader ---
-    def load_clothing_data():
-        """Loads clothing data from the CSV file."""
-        try:
-            import pandas as pd
-            df = pd.read_csv("clothing_data.csv")
-            return {row['name']: row['image_file'] for index, row in df.iterrows()}
-        except FileNotFoundError:
-            st.error("Error: clothing_data.csv not found.")
-            return {}
-        except Exception as e:
-            st.error(f"An error occurred while loading clothing data: {e}")
-            return {}
-
     clothing_options = load_clothing_data()
 
     if clothing_options:
@@ -121,7 +367,7 @@ if 'user_image_path' in st.session_state and selected_clothing_name:
     st.header("Your New Look!")
     
     # Load images again to ensure we have fresh copies
-    user_image = load_image(st.session_state.user_image_path)
+    user_image = load_image(st.session_state.user_image_path, max_size=PREVIEW_SIZE)
     clothing_image_path = os.path.join("images", "clothing", clothing_options[selected_clothing_name])
     clothing_image = load_image(clothing_image_path)
 
@@ -130,46 +376,75 @@ if 'user_image_path' in st.session_state and selected_clothing_name:
         user_width, user_height = user_image.size
 
         st.sidebar.header("Adjust Clothing")
-        scale = st.sidebar.slider("Size", 0.1, 5.0, 1.0, 0.05)
-        x_offset = st.sidebar.slider("Horizontal Position", -user_width // 2, user_width // 2, 0)
-        y_offset = st.sidebar.slider("Vertical Position", -user_height // 2, user_height // 2, 0)
-
-        # Resize clothing based on scale
-        clothing_width = int(clothing_image.width * scale)
-        clothing_height = int(clothing_image.height * scale)
-        clothing_image_resized = clothing_image.resize((clothing_width, clothing_height), Image.Resampling.LANCZOS)
+        # Sliders live in a form so dragging them only reruns the app when "Apply" is pressed
+        with st.sidebar.form("adjust"):
+            scale = st.slider("Size", 0.1, 5.0, 1.0, SCALE_STEP)
+            x_offset = st.slider("Horizontal Position", -user_width // 2, user_width // 2, 0)
+            y_offset = st.slider("Vertical Position", -user_height // 2, user_height // 2, 0)
+            st.form_submit_button("Apply")
+
+        # Size the clothing based on scale, snapped to the slider step so reruns hit the cache
+        scale_steps = round(scale / SCALE_STEP)
+        clothing_mtime = os.path.getmtime(clothing_image_path)
+        clothing_width, clothing_height = scaled_size(clothing_image.size, scale_steps * SCALE_STEP)
         
         # Calculate position based on offsets
         position_x = (user_width - clothing_width) // 2 + x_offset
         position_y = (user_height - clothing_height) // 2 + y_offset
         
-        # Create the final image
-        final_image = overlay_image(user_image, clothing_image_resized, (position_x, position_y))
-        
-        st.image(final_image, caption="Here's your virtual try-on!", use_container_width=True)
+        # Let the browser stack the two layers so slider moves need no server-side compositing
+        user_mtime = os.path.getmtime(st.session_state.user_image_path)
+        background_uri = image_data_uri(user_image, ("user", st.session_state.user_image_path, user_mtime))
+        overlay = preview_overlay(
+            clothing_image_path,
+            clothing_image.size,
+            scale_steps,
+            clothing_mtime,
+            (position_x, position_y),
+            user_image.size,
+        )
+        st.markdown(
+            layered_preview_html(background_uri, overlay, user_image.size),
+            unsafe_allow_html=True,
+        )
+        st.caption("Here's your virtual try-on!")
 
         # --- Download Button ---
-        # To download the image, we need to convert it to bytes
-        from io import BytesIO
-        buf = BytesIO()
-        final_image.save(buf, format="PNG")
-        byte_im = buf.getvalue()
-
-        st.download_button(
-            label="Download Your New Look",
-            data=byte_im,
-            file_name="virtual_look.png",
-            mime="image/png"
-        )
+        # The composite is only built and encoded when the user asks for it
+        if st.button("Prepare Download"):
+            # JPEG photos are downloaded as JPEG; PNGs keep PNG so any transparency survives
+            if is_jpeg_path(st.session_state.user_image_path):
+                fmt, file_name, mime = "JPEG", "virtual_look.jpg", "image/jpeg"
+            else:
+                fmt, file_name, mime = "PNG", "virtual_look.png", "image/png"
+            byte_im = build_download(
+                st.session_state.user_image_path,
+                user_mtime,
+                clothing_image_path,
+                clothing_mtime,
+                scale_steps,
+                (position_x, position_y),
+                user_image.size,
+                fmt,
+            )
+
+            st.download_button(
+                label="Download Your New Look",
+                data=byte_im,
+                file_name=file_name,
+                mime=mime
+            )
 
 # --- Instructions and Tips ---
 st.sidebar.title("How to Use")
 st.sidebar.info("""
 1.  **Upload Your Photo:** Click the 'Browse files' button and select a clear, front-facing photo of yourself.
-2.  **Choose Clothing:** Select an item from the dropdown menu to see it on your photo.
+2.  **Choose Clothing:** Select an item from the dropdown menu to see it on your photo, then adjust its size and position in the sidebar and press 'Apply'.
 3.  **View & Download:** See the result in the 'Your New Look!' section and download it if you like.
 """)
 
 st.sidebar.title("About")
 st.sidebar.info("This is a simple virtual fitting room application built with Streamlit and Python.")
+# Pillow-SIMD releases carry a ".postN" suffix, so show which build is doing the image work
+st.sidebar.caption(f"PIL {PIL.__version__}{'-SIMD' if 'post' in PIL.__version__ else ''}")
 
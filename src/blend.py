@@ -0,0 +1,47 @@
+"""Alpha blending kernels for the fitting room composite.
+
+These live outside app.py because Streamlit re-executes the app script on every
+rerun; defining the Numba kernel here means it is compiled once per process.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is opt-in; the NumPy blend is used without it
+    njit = None
+
+# Working-set budget for one panel of the NumPy blend, roughly a per-core L2 cache
+BLEND_PANEL_BYTES = 512 * 1024
+# uint8 inputs plus the uint16 temporaries NumPy allocates per pixel of a panel
+BLEND_BYTES_PER_PIXEL = 36
+
+def panel_rows(width):
+    """Returns how many rows of a ``width``-pixel wide region fit in BLEND_PANEL_BYTES."""
+    return max(1, BLEND_PANEL_BYTES // (width * BLEND_BYTES_PER_PIXEL))
+
+def blend_over_numpy(region, fg):
+    """Porter-Duff "over" of a premultiplied RGBA array onto ``region``, in place."""
+    # Work in row panels so the uint16 temporaries stay in cache
+    rows = panel_rows(fg.shape[1])
+    for start in range(0, fg.shape[0], rows):
+        stop = start + rows
+        fg_block = fg[start:stop]
+        region_block = region[start:stop]
+        alpha = fg_block[..., 3:4].astype(np.uint16)
+        region_block[...] = fg_block + region_block * (255 - alpha) // 255
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def blend_over(region, fg):
+        """Numba version of blend_over_numpy that splits the rows across CPU cores.
+
+        It needs no panels: there are no temporaries, and prange already gives
+        each thread a contiguous band of rows, even for short overlays.
+        """
+        for y in prange(fg.shape[0]):
+            for x in range(fg.shape[1]):
+                inv_alpha = 255 - np.uint16(fg[y, x, 3])
+                for c in range(4):
+                    region[y, x, c] = fg[y, x, c] + region[y, x, c] * inv_alpha // 255
+else:
+    blend_over = blend_over_numpy
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app modules live in src/ and are imported by name, as Streamlit runs them
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import blend
+
+KERNELS = [blend.blend_over_numpy, blend.blend_over]
+
+
+def premultiply(rgba):
+    out = rgba.copy()
+    alpha = rgba[..., 3:4].astype(np.uint16)
+    out[..., :3] = rgba[..., :3] * alpha // 255
+    return out
+
+
+def random_rgba(rng, height, width):
+    return rng.integers(0, 256, size=(height, width, 4), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("kernel", KERNELS, ids=["blend_over_numpy", "blend_over"])
+@pytest.mark.parametrize("width", [1, 97, 640, 20000])
+def test_blend_matches_alpha_composite(kernel, width):
+    rng = np.random.default_rng(width)
+    # One full panel plus a partial one, so the tail panel is covered too
+    rows = blend.panel_rows(width)
+    height = rows + rows // 2 + 1
+    fg = random_rgba(rng, height, width)
+    bg = random_rgba(rng, height, width)
+
+    expected = np.array(Image.alpha_composite(Image.fromarray(bg), Image.fromarray(fg)))
+    region = premultiply(bg)
+    kernel(region, premultiply(fg))
+
+    # Compare in premultiplied space. The kernels floor when premultiplying and
+    # again when blending, while alpha_composite rounds, so allow a few levels
+    diff = np.abs(region.astype(np.int16) - premultiply(expected).astype(np.int16))
+    assert diff.max() <= 3
+    assert diff.mean() < 1
+
+
+@pytest.mark.parametrize("kernel", KERNELS, ids=["blend_over_numpy", "blend_over"])
+def test_blend_on_opaque_background_keeps_it_opaque(kernel):
+    rng = np.random.default_rng(0)
+    width = 97
+    height = 2 * blend.panel_rows(width) + 1
+    fg = premultiply(random_rgba(rng, height, width))
+    region = random_rgba(rng, height, width)
+    region[..., 3] = 255
+    kernel(region, fg)
+    assert (region[..., 3] == 255).all()